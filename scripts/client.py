@@ -1,9 +1,11 @@
 #!/usr/bin/python3
 import argparse
+import ipaddress
 import os
+import selectors
 import socket
 import struct
-import re
+import sys
 import threading
 from enum import Enum
 
@@ -15,6 +17,30 @@ BCP_MAX_STR_LEN = 4095
 
 BCP_DEFAULT_TIMEOUT = 6000
 
+# BCP opcodes as plain ints for per-message paths (see BCPClient.BCP_OPCODE)
+BCP_OPC_REGISTER = 1
+BCP_OPC_SEND = 2
+BCP_OPC_DELVR = 3
+BCP_OPC_STAT = 4
+
+# client connection states as plain ints (see BCPClient.BCP_CONN_STATUS)
+BCP_STATE_SETUP = 0
+BCP_STATE_READY = 1
+BCP_STATE_PENDING_STATUS = 2
+BCP_STATE_SHUTDOWN = 3
+
+# inbound msg layouts: opcode -> (offset of first string field, number of string fields)
+BCP_MSG_LAYOUT = {
+    BCP_OPC_DELVR: (1, 2),  # opcode | from:string | message:string
+    BCP_OPC_STAT: (2, 1),  # opcode | code:u8 | message:string
+}
+
+# precompiled packers for fixed-layout BCP fields
+BCP_LEN_FMT = struct.Struct("!h")  # string length prefix
+BCP_STAT_HDR_FMT = struct.Struct("!Bh")  # inbound status code + message length
+BCP_STAT_MSG_FMT = struct.Struct("!BB")  # outbound status opcode + code
+BCP_STR_HDR_FMT = struct.Struct("!Bh")  # outbound opcode + string length
+
 
 class BCPClient:
     '''
@@ -22,16 +48,16 @@ class BCPClient:
     '''
 
     class BCP_OPCODE(Enum):
-        REGISTER = 1
-        SEND = 2
-        DELVR = 3
-        STAT = 4
+        REGISTER = BCP_OPC_REGISTER
+        SEND = BCP_OPC_SEND
+        DELVR = BCP_OPC_DELVR
+        STAT = BCP_OPC_STAT
 
     class BCP_CONN_STATUS(Enum):
-        SETUP = 0
-        READY = 1
-        PENDING_STATUS = 2
-        SHUTDOWN = 3
+        SETUP = BCP_STATE_SETUP
+        READY = BCP_STATE_READY
+        PENDING_STATUS = BCP_STATE_PENDING_STATUS
+        SHUTDOWN = BCP_STATE_SHUTDOWN
 
     def __init__(self, remote_port, remote_ip, username):
         # set fields
@@ -39,17 +65,26 @@ class BCPClient:
         self.outbound_thread = None  # holds thread for outgoing operations
         self.sock = None  # holds ref to connected TCP socket
         self.sock: socket.socket
+        self.recv_buf = bytearray(BCP_MAX_MSG_SIZE)  # reusable buffer for inbound messages
+        self.recv_view = memoryview(self.recv_buf)
+        self.recv_len = 0  # length of partial msg held at front of recv_buf
         self.username = username  # BCP username
+        self.register_msg = pack_str_msg(BCP_OPC_REGISTER, username.encode('utf-8'))  # fixed for session
         self.last_msg = None
         self.return_code = 0
         self.remote_port = remote_port  # Remote BCP Server Port
         self.remote_ip = remote_ip  # Remote BCP Server Addr
-        self.client_state = self.BCP_CONN_STATUS.SETUP.value  # current state of client
-        self.conn_lock = threading.Lock()  # lock for connection operations
+        # current state of client; a single int, so plain loads/stores are atomic under the GIL.
+        # only written by the inbound thread once it is running (threaded mode)
+        self.client_state = BCP_STATE_SETUP
+        # set when client may send or has shut down; cleared while a SEND awaits its status
+        self.ready_event = threading.Event()
         self.screen_lock = threading.Lock()  # lock for screen operations
         self.timeout = BCP_DEFAULT_TIMEOUT  # how long to wait before operation failure
         self.screen = ""
         self.prompt = ""
+        # handlers for inbound messages, keyed by opcode
+        self.msg_handlers = {BCP_OPC_STAT: self.handle_stat, BCP_OPC_DELVR: self.handle_deliver_ack}
         # set remaining fields
 
         # create locks
@@ -68,12 +103,17 @@ class BCPClient:
             print("Unable to connect to server")
             return False
         self.register_client()
-        # define threads
-        self.inbound_thread = threading.Thread(target=self.handle_inbound, daemon=True)
-        # start threads
-        self.inbound_thread.start()
-        # main (input) thread
-        self.handle_outbound()
+        # WINDOWS: console input can't be selected on, so serve server and user on separate threads
+        if os.name == 'nt':
+            # define threads
+            self.inbound_thread = threading.Thread(target=self.handle_inbound, daemon=True)
+            # start threads
+            self.inbound_thread.start()
+            # main (input) thread
+            self.handle_outbound()
+        # LINUX
+        else:
+            self.handle_events()
         exit(self.return_code)
 
     def clear_screen(self):
@@ -83,11 +123,13 @@ class BCPClient:
         '''
         # WINDOWS
         if os.name == 'nt':
+            sys.stdout.flush()  # cls draws directly to console, so push anything buffered first
             _ = os.system('cls')
 
         # LINUX
         else:
-            _ = os.system('clear')
+            # ANSI home + clear screen/scrollback; buffered in order with following output
+            sys.stdout.write("\033[H\033[2J\033[3J")
 
     def input_screen(self, prompt):
         '''
@@ -96,14 +138,22 @@ class BCPClient:
         :return: Input that was sent
         '''
         user_input = None
-        with self.screen_lock:
-            self.clear_screen()
-            print(self.screen)
+        self.draw_screen()
         user_input = input(prompt)
         with self.screen_lock:
             self.prompt = prompt
         return user_input
 
+    def draw_screen(self):
+        '''
+        Redraw contents of buffer ahead of reading input
+        :return: None
+        '''
+        with self.screen_lock:
+            self.clear_screen()
+            sys.stdout.write(self.screen + '\n')
+            sys.stdout.flush()  # always show screen before prompting
+
     def print_screen(self, msg):
         '''
         Print contents of buffer and a new message on to screen
@@ -113,8 +163,16 @@ class BCPClient:
         with self.screen_lock:
             self.clear_screen()
             self.screen += (msg + '\n')
-            print(self.screen.rstrip())  # print contents of screen
-            print(self.prompt)  # always print prompt beneath
+            # contents of screen, prompt always beneath; left buffered until flush_screen
+            sys.stdout.write(f"{self.screen.rstrip()}\n{self.prompt}\n")
+
+    def flush_screen(self):
+        '''
+        Push buffered screen output to the terminal
+        :return: None
+        '''
+        with self.screen_lock:
+            sys.stdout.flush()
 
     def handle_outbound(self):
         '''
@@ -122,102 +180,192 @@ class BCPClient:
         :return: Runs continuously until exited by user
         '''
         while True:
-            self.conn_lock.acquire()
-            if self.client_state is self.BCP_CONN_STATUS.SHUTDOWN.value:
+            # block until client ready to send or shut down
+            self.ready_event.wait()
+            if self.client_state == BCP_STATE_SHUTDOWN:
                 return
-            # if client ready to send, allow submission message
-            if self.client_state is self.BCP_CONN_STATUS.READY.value:
-                # print last message as applicable
-                if self.last_msg is not None:
-                    self.print_screen(f"{self.username}: {self.last_msg}")
-                # attempt to get input for msg
-                self.conn_lock.release()
-                self.last_msg = self.input_screen("")
-                if (len(self.last_msg) == 0):
-                    self.last_msg = ' '
-                # send completed input
-                self.send_send(self.last_msg)
-                self.conn_lock.acquire()
-                self.client_state = self.BCP_CONN_STATUS.PENDING_STATUS.value
-            self.conn_lock.release()
+            # print last message as applicable
+            if self.last_msg is not None:
+                self.print_screen(f"{self.username}: {self.last_msg}")
+            # attempt to get input for msg
+            self.last_msg = self.input_screen("")
+            if (len(self.last_msg) == 0):
+                self.last_msg = ' '
+            # clear before sending so a fast status reply is not lost
+            self.ready_event.clear()
+            # send completed input
+            self.send_send(self.last_msg)
+
+    def handle_events(self):
+        '''
+        Handle messages from server and user on a single thread (not supported on Windows)
+        :return: Runs until server disconnects or user input is closed
+        '''
+        # two fds whose interest changes every message: select needs no per-change syscalls, unlike
+        # epoll, and also accepts stdin redirected from a regular file
+        sel = selectors.SelectSelector()
+        sel.register(self.sock, selectors.EVENT_READ)
+        stdin_fd = sys.stdin.fileno()
+        awaiting_input = False  # stdin registered with sel
+        user_input = b''  # input not yet sent
+        try:
+            while True:
+                # only take input while ready to send; waiting on a status reply otherwise
+                if self.client_state == BCP_STATE_READY:
+                    if not awaiting_input:
+                        # print last message as applicable
+                        if self.last_msg is not None:
+                            self.print_screen(f"{self.username}: {self.last_msg}")
+                        self.draw_screen()
+                        sel.register(stdin_fd, selectors.EVENT_READ)
+                        awaiting_input = True
+                    # send completed input
+                    if b'\n' in user_input:
+                        line, user_input = user_input.split(b'\n', 1)
+                        sel.unregister(stdin_fd)
+                        awaiting_input = False
+                        self.last_msg = line.decode('utf-8', errors='replace')
+                        if (len(self.last_msg) == 0):
+                            self.last_msg = ' '
+                        self.client_state = BCP_STATE_PENDING_STATUS
+                        self.send_send(self.last_msg)
+                        continue
+                for key, _ in sel.select():
+                    if key.fileobj is self.sock:
+                        if not self.recv_msgs():
+                            # signal shutdown
+                            print("Server disconnected.\n", flush=True)
+                            self.client_state = BCP_STATE_SHUTDOWN
+                            return
+                    else:
+                        received = os.read(stdin_fd, BCP_MAX_STR_LEN)
+                        # user closed input
+                        if len(received) == 0:
+                            return
+                        user_input += received
+        finally:
+            sel.close()
 
     def handle_inbound(self):
         '''
         Handle messages coming from server
         :return: Exits caller (thread/app) on error or receipt of negative status message
         '''
-        received = None
-        msg_buf = None
-        while True:
-            # attempt to get incoming
-            try:
-                received = self.sock.recv(1)
-            except ConnectionError as e:
-                break
-            # sock.recv should return b'' on close
-            if len(received) == 0:
-                break
-            with self.conn_lock:
-                self.handle_incoming_msg(received)
+        while self.recv_msgs():
+            pass
         # signal shutdown
-        print("Server disconnected.\n")
-        self.client_state = self.BCP_CONN_STATUS.SHUTDOWN.value
+        print("Server disconnected.\n", flush=True)
+        self.client_state = BCP_STATE_SHUTDOWN
+        self.ready_event.set()
         exit(1)
 
-    def handle_deliver(self):
+    def recv_msgs(self):
         '''
-        Handle an inbound deliver msg
-        :return: True if Deliver handled successfully; False if not
+        Receive from server and handle every complete msg received so far
+        :return: True if connection still open; False if server disconnected
         '''
-        sender_len, sender, content_len, content = None, None, None, None
-        msg = ""
-        index = 1  # skip opcode
-        sender_len_len = 2
-        content_len_len = 2
+        recv_view = self.recv_view
+        # attempt to get incoming
         try:
-            # sender field
-            msg = self.sock.recv(sender_len_len)
-            sender_len = struct.unpack("!h", msg)[0]
-            index += sender_len_len
-            msg = self.sock.recv(sender_len)
-            sender = struct.unpack(f"!{sender_len}s", msg)[0]
-            index += sender_len
-            # message field
-            msg = self.sock.recv(content_len_len)
-            content_len = struct.unpack("!h", msg)[0]
-            index += content_len_len
-            msg = self.sock.recv(content_len)
-            content = struct.unpack(f"!{content_len}s", msg)[0]
-            index += content_len
-        except:
-            print("Error: Invalid message received from server.")
+            received = self.sock.recv_into(recv_view[self.recv_len:])
+        except ConnectionError as e:
             return False
+        # sock.recv_into should return 0 on close
+        if received == 0:
+            return False
+        start, end = 0, self.recv_len + received  # bounds of unhandled bytes in recv_buf
+        # handle every complete msg in buffer
+        while start < end:
+            msg_len = self.get_msg_len(recv_view[start:end])
+            if msg_len == 0:
+                break
+            if msg_len < 0:
+                # framing lost, discard what was received
+                print("Error: Invalid message received from server.")
+                start = end
+                break
+            self.handle_incoming_msg(recv_view[start:start + msg_len])
+            start += msg_len
+        # one terminal write for everything handled from this recv
+        self.flush_screen()
+        # move any partial msg to front of buffer
+        if start > 0:
+            recv_view[:end - start] = recv_view[start:end]
+            end -= start
+        if end == len(self.recv_buf):
+            print("Error: Invalid message received from server.")
+            end = 0
+        self.recv_len = end
+        return True
 
-        sender = sender.decode().replace('\x00', '')
-        content = content.decode().replace('\x00', '')
+    def get_msg_len(self, msg):
+        '''
+        Determine length of the msg at the start of received data
+        :param msg: Received data, beginning with an opcode
+        :return: Length of msg; 0 if msg is not fully received yet; -1 if msg is invalid
+        '''
+        layout = BCP_MSG_LAYOUT.get(msg[0])
+        if layout is None:
+            return 1  # unknown opcode, skip it
+        index, num_fields = layout
+        for _ in range(num_fields):
+            if index + BCP_LEN_FMT.size > len(msg):
+                return 0
+            field_len = BCP_LEN_FMT.unpack_from(msg, index)[0]
+            if field_len < 0:
+                return -1
+            index += BCP_LEN_FMT.size + field_len
+        if index > len(msg):
+            return 0
+        return index
+
+    def handle_deliver(self, msg):
+        '''
+        Handle an inbound deliver msg
+        :param msg: Complete deliver msg
+        :return: True if Deliver handled successfully; False if not
+        '''
+        index = 1  # skip opcode
+        # sender field
+        sender_len = BCP_LEN_FMT.unpack_from(msg, index)[0]
+        index += BCP_LEN_FMT.size
+        sender = bytes(msg[index:index + sender_len])
+        index += sender_len
+        # message field
+        content_len = BCP_LEN_FMT.unpack_from(msg, index)[0]
+        index += BCP_LEN_FMT.size
+        content = bytes(msg[index:index + content_len])
+        index += content_len
+
+        # fields may be NUL terminated/padded; keep C string contents only
+        sender = sender.split(b'\x00', 1)[0].decode('utf-8', errors='replace')
+        content = content.split(b'\x00', 1)[0].decode('utf-8', errors='replace')
         self.print_screen(f"{sender}: {content}")
         return True
 
-    def handle_stat(self):
+    def handle_deliver_ack(self, msg):
+        '''
+        Handle an inbound deliver msg and acknowledge it with a status msg
+        :param msg: Complete deliver msg
+        :return: True if Deliver handled successfully; False if not
+        '''
+        updated_msg = self.handle_deliver(msg)
+        # NOTE: assumes status 0 is good and status 1 is error
+        self.send_stat(int(updated_msg == False))
+        return updated_msg
+
+    def handle_stat(self, msg):
         '''
         Handle an inbound status msg
+        :param msg: Complete status msg
         :return: True if status handled successfully; False if not
         '''
-        stat, stat_msg_len, stat_msg = None, None, None
-        msg = ""
-        len_statcode = 1
-        len_msg_len = 2
-        offset = len_statcode + len_msg_len
-        try:
-            msg = self.sock.recv(offset)
-            stat, stat_msg_len = struct.unpack("!Bh", msg)
-            if stat_msg_len > 0:
-                msg = self.sock.recv(stat_msg_len)
-                offset += stat_msg_len
-                stat_msg = struct.unpack(f"{stat_msg_len}s", msg)[0].decode()
-        except:
-            print("Error: Invalid message received from server.")
-            return False
+        stat_msg = None
+        offset = 1  # skip opcode
+        stat, stat_msg_len = BCP_STAT_HDR_FMT.unpack_from(msg, offset)
+        offset += BCP_STAT_HDR_FMT.size
+        if stat_msg_len > 0:
+            stat_msg = bytes(msg[offset:offset + stat_msg_len]).decode('utf-8', errors='replace')
         self.return_code = stat
         # if stat bad..
         if stat != 0:
@@ -225,9 +373,9 @@ class BCPClient:
         # notify client
         if stat_msg:
             self.print_screen(f"Server: {stat_msg}")
-        # set state to READY
-        if self.client_state is not self.BCP_CONN_STATUS.READY.value:
-            self.client_state = self.BCP_CONN_STATUS.READY.value
+        # set state to READY and wake outbound
+        self.client_state = BCP_STATE_READY
+        self.ready_event.set()
         return True
 
     def parse_commands(self):
@@ -242,10 +390,8 @@ class BCPClient:
         :return: True
         '''
         ret_stat = None
-        fmt = f"!Bh{len(self.username)}s"
-        msg = struct.pack(fmt, BCPClient.BCP_OPCODE.REGISTER.value, len(self.username), self.username.encode('utf-8'))
         # send
-        self.sock.sendall(msg)
+        self.sock.sendall(self.register_msg)
         # await response
         return True
 
@@ -255,12 +401,26 @@ class BCPClient:
         :param content: Content to send
         :return: True if send operation successful; False if not
         '''
-        # trim to fit
-        content = content[:min(len(content), BCP_MAX_STR_LEN)]
-        # encode and pack
-        fmt = f"!Bh{len(content)}s"
-        msg = struct.pack(fmt, BCPClient.BCP_OPCODE.SEND.value, len(content), content.encode('utf-8'))
-        return None is self.sock.sendall(msg)
+        # encode and trim to fit
+        content = content.encode('utf-8')[:BCP_MAX_STR_LEN]
+        # header and content go out as separate buffers, content is never copied
+        header = BCP_STR_HDR_FMT.pack(BCP_OPC_SEND, len(content))
+        return None is self.send_vectored(header, content)
+
+    def send_vectored(self, *parts):
+        '''
+        Send a msg made up of several buffers without joining them first
+        :param parts: Buffers making up the msg, in order
+        :return: None; raises OSError if send fails
+        '''
+        # WINDOWS: no scatter/gather send
+        if not hasattr(self.sock, 'sendmsg'):
+            self.sock.sendall(b''.join(parts))
+            return
+        sent = self.sock.sendmsg(parts)
+        if sent < sum(len(part) for part in parts):
+            # stream socket took only part of msg; send remainder contiguously
+            self.sock.sendall(b''.join(parts)[sent:])
 
     def send_stat(self, stat_code):
         '''
@@ -271,8 +431,7 @@ class BCPClient:
         # trim
         stat_code = int(str(stat_code)[:1])
         # encode and pack
-        fmt = f"!BB"
-        msg = struct.pack(fmt, BCPClient.BCP_OPCODE.STAT.value, stat_code)
+        msg = BCP_STAT_MSG_FMT.pack(BCP_OPC_STAT, stat_code)
         return None is self.sock.sendall(msg)
 
     def setup_socket(self):
@@ -280,7 +439,10 @@ class BCPClient:
         Initializes a TCP socket for program and connect to server
         '''
         new_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        new_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 0)
+        # chat msgs are small and interactive; send immediately rather than wait on Nagle
+        new_sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        # let the kernel detect a vanished server instead of blocking in recv forever
+        new_sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
         try:
             new_sock.connect((self.remote_ip, self.remote_port))
         except Exception as e:
@@ -290,16 +452,25 @@ class BCPClient:
         return True
 
     def handle_incoming_msg(self, msg):
-        updated_msg = False
-        # get opcode
-        opc = struct.unpack("!B", msg[:1])[0]
-        if opc is self.BCP_OPCODE.STAT.value:
-            updated_msg = self.handle_stat()
-        elif opc is self.BCP_OPCODE.DELVR.value:
-            updated_msg = self.handle_deliver()
-            # NOTE: assumes status 0 is good and status 1 is error
-            self.send_stat(int(updated_msg == False))
-        return updated_msg
+        # dispatch on opcode; unknown opcodes are ignored
+        handler = self.msg_handlers.get(msg[0])
+        if handler is None:
+            return False
+        return handler(msg)
+
+
+def pack_str_msg(opcode, data):
+    '''
+    Pack a msg consisting of an opcode and a single string field
+    :param opcode: BCP opcode of msg
+    :param data: Encoded string contents
+    :return: bytearray holding the packed msg
+    '''
+    # one allocation: header packed in place, contents copied in behind it
+    msg = bytearray(BCP_STR_HDR_FMT.size + len(data))
+    BCP_STR_HDR_FMT.pack_into(msg, 0, opcode, len(data))
+    msg[BCP_STR_HDR_FMT.size:] = data
+    return msg
 
 
 def invalid_args(args):
@@ -310,12 +481,18 @@ def invalid_args(args):
     '''
     # validation
     error = False
-    if not re.match("^(?:[0-9]{1,3}\.){3}[0-9]{1,3}$", args.s):
+    try:
+        ipaddress.IPv4Address(args.s)
+    except ValueError:
         print("Invalid IP Address")
         error = True
-    if args.p >= PORT_MAX:
+    if args.p < 1 or args.p > PORT_MAX:
         print("Invalid Port")
         error = True
+    # username is sent as a single BCP string
+    if len(args.u.encode('utf-8')) > BCP_MAX_STR_LEN:
+        print("Invalid Username")
+        error = True
     return error
 
 
@@ -330,6 +507,9 @@ def main():
 
     args = parser.parse_args()
 
+    # screen output is flushed explicitly once per batch of inbound msgs and before prompts
+    sys.stdout.reconfigure(line_buffering=False, write_through=False)
+
     if invalid_args(args):
         return 1
 